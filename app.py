@@ -1,27 +1,157 @@
 import streamlit as st
-import cv2
 import numpy as np
-import pandas as pd
-from PIL import Image
 import json
 import os
 from datetime import datetime
 import io
+import csv
+import time
+import queue
+import threading
+import logging
+from collections import deque
+from functools import lru_cache
 
-# Import custom utilities
-from utils.image_processor import ImageProcessor
-from utils.ml_models import PlantHealthDetector, SoilHealthDetector
-from utils.backup_system import BackupManager
-from utils.recommendations import RecommendationEngine
+# Longest image edge fed to the detectors; larger uploads are downscaled
+MAX_EDGE = 1024
+
+# Minimum green/brown mask mean (0-255) for the quick auto-detect to be trusted
+MIN_COLOR_COVERAGE = 0.05 * 255
+
+# Number of analyses kept in the session history
+MAX_HISTORY = 200
+
+# Full analyses are appended here; the session keeps only these summary fields
+HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.jsonl")
+HISTORY_FIELDS = ['type', 'result', 'confidence', 'timestamp', 'image_name']
 
 # Initialize components
 @st.cache_resource
 def load_models():
     """Load ML models (cached for performance)"""
+    from utils.ml_models import PlantHealthDetector, SoilHealthDetector
+    
     plant_detector = PlantHealthDetector()
     soil_detector = SoilHealthDetector()
     return plant_detector, soil_detector
 
+@st.cache_resource
+def load_processors():
+    """Load image processing and recommendation helpers (cached for performance)"""
+    from utils.image_processor import ImageProcessor
+    from utils.recommendations import RecommendationEngine
+    
+    image_processor = ImageProcessor()
+    recommendation_engine = RecommendationEngine()
+    return image_processor, recommendation_engine
+
+@st.cache_resource
+def load_backup_manager():
+    """Create the backup manager (shared with the backup worker)"""
+    from utils.backup_system import BackupManager
+    
+    return BackupManager()
+
+def append_history(analysis_result):
+    """Append a full analysis record to the on-disk history"""
+    with open(HISTORY_PATH, 'a', buffering=1024 * 1024) as f:
+        f.write(json.dumps(analysis_result, default=str) + "\n")
+
+@st.cache_resource
+def start_backup_worker():
+    """Start a daemon thread that writes history and backups off the request path"""
+    backup_queue = queue.Queue()
+    backup_manager = load_backup_manager()
+    
+    def worker():
+        while True:
+            analysis_result, file_bytes, file_name = backup_queue.get()
+            try:
+                append_history(analysis_result)
+            except OSError:
+                logging.getLogger(__name__).exception("History append failed for %s", file_name)
+            try:
+                uploaded_file = io.BytesIO(file_bytes)
+                uploaded_file.name = file_name
+                backup_manager.backup_analysis(analysis_result, uploaded_file)
+            except Exception:
+                logging.getLogger(__name__).exception("Backup failed for %s", file_name)
+            finally:
+                backup_queue.task_done()
+    
+    threading.Thread(target=worker, name="backup-worker", daemon=True).start()
+    return backup_queue
+
+@lru_cache(maxsize=256)
+def format_timestamp(seconds: int) -> str:
+    """Format an epoch timestamp (whole seconds) for display"""
+    return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+def decode_image(file_bytes: bytes):
+    """Decode uploaded bytes into an RGB array, downscaling large photos"""
+    import cv2
+    
+    # Decode straight into an OpenCV array (no PIL round trip)
+    raw = np.frombuffer(file_bytes, dtype=np.uint8)
+    bgr = cv2.imdecode(raw, cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError("Could not decode the uploaded image.")
+    
+    # Downscale large photos before analysis
+    scale = min(1.0, MAX_EDGE / max(bgr.shape[:2]))
+    if scale < 1.0:
+        bgr = cv2.resize(bgr, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+    # Swap channels in place; bgr is a fresh buffer from imdecode/resize
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=bgr)
+
+def quick_detect_type(image):
+    """Classify an RGB image as plant or soil by green/brown pixel ratio (None if unsure)"""
+    import cv2
+    
+    thumb = cv2.resize(image, (128, 128), interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(thumb, cv2.COLOR_RGB2HSV)
+    green = cv2.inRange(hsv, (35, 40, 40), (85, 255, 255)).mean()
+    brown = cv2.inRange(hsv, (10, 40, 20), (30, 255, 200)).mean()
+    if max(green, brown) < MIN_COLOR_COVERAGE:
+        return None
+    return "plant" if green > brown else "soil"
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def analyze_bytes(file_bytes: bytes, analysis_type: str) -> dict | None:
+    """Run the full analysis pipeline for an image (cached by content)"""
+    plant_detector, soil_detector = load_models()
+    image_processor, recommendation_engine = load_processors()
+    
+    image = decode_image(file_bytes)
+    processed_image = image_processor.preprocess_image(image)
+    
+    # Determine analysis type, trying the cheap colour check first
+    if analysis_type == "Auto-detect":
+        detected_type = quick_detect_type(image)
+        if detected_type is None:
+            detected_type = image_processor.detect_image_type(processed_image)
+    else:
+        detected_type = analysis_type.replace(" Health", "").lower()
+    
+    # Perform analysis
+    if detected_type == "plant":
+        result = plant_detector.analyze(processed_image)
+        result_type = 'Plant Health'
+    elif detected_type == "soil":
+        result = soil_detector.analyze(processed_image)
+        result_type = 'Soil Health'
+    else:
+        return None
+    
+    analysis_result = {
+        'type': result_type,
+        'result': result['condition'],
+        'confidence': result['confidence'],
+        'details': result['details']
+    }
+    analysis_result['recommendations'] = recommendation_engine.get_recommendations(analysis_result)
+    return analysis_result
+
 def main():
     st.set_page_config(
         page_title="AI Plant & Soil Health Detection",
@@ -34,14 +164,16 @@ def main():
     
     # Initialize session state
     if 'analysis_history' not in st.session_state:
-        st.session_state.analysis_history = []
+        st.session_state.analysis_history = deque(maxlen=MAX_HISTORY)
+        st.session_state.counts = {'Plant Health': 0, 'Soil Health': 0}
+    analysis_result = st.session_state.get('last_result')
     
     # Load models
     try:
-        plant_detector, soil_detector = load_models()
-        image_processor = ImageProcessor()
-        backup_manager = BackupManager()
-        recommendation_engine = RecommendationEngine()
+        load_models()
+        load_processors()
+        backup_manager = load_backup_manager()
+        backup_queue = start_backup_worker()
     except Exception as e:
         st.error(f"Error loading system components: {str(e)}")
         st.stop()
@@ -64,17 +196,25 @@ def main():
         
         st.header("Analysis History")
         if st.button("Clear History"):
-            st.session_state.analysis_history = []
+            st.session_state.analysis_history = deque(maxlen=MAX_HISTORY)
+            st.session_state.counts = {'Plant Health': 0, 'Soil Health': 0}
             st.rerun()
         
         # Display recent analyses
         if st.session_state.analysis_history:
-            for i, analysis in enumerate(st.session_state.analysis_history[-5:]):
-                with st.expander(f"Analysis {len(st.session_state.analysis_history) - i}"):
-                    st.write(f"**Type:** {analysis['type']}")
-                    st.write(f"**Result:** {analysis['result']}")
-                    st.write(f"**Confidence:** {analysis['confidence']:.2f}")
-                    st.write(f"**Time:** {analysis['timestamp']}")
+            rows = [
+                {**analysis, 'timestamp': format_timestamp(int(analysis['timestamp']))}
+                for analysis in list(st.session_state.analysis_history)[-5:]
+            ]
+            st.dataframe(
+                rows,
+                hide_index=True,
+                column_config={
+                    'confidence': st.column_config.ProgressColumn(
+                        "confidence", format="%.2f", min_value=0.0, max_value=1.0
+                    )
+                }
+            )
     
     # Main content area
     col1, col2 = st.columns([1, 1])
@@ -89,51 +229,42 @@ def main():
         
         if uploaded_file is not None:
             try:
-                # Display uploaded image
-                image = Image.open(uploaded_file)
-                st.image(image, caption="Uploaded Image", use_column_width=True)
+                file_bytes = uploaded_file.getvalue()
                 
-                # Process image
-                with st.spinner("Processing image..."):
-                    processed_image = image_processor.preprocess_image(image)
-                    
-                    # Determine analysis type
-                    if analysis_type == "Auto-detect":
-                        detected_type = image_processor.detect_image_type(processed_image)
-                        st.info(f"Auto-detected: {detected_type}")
-                    else:
-                        detected_type = analysis_type.replace(" Health", "").lower()
-                    
-                    # Perform analysis
-                    if detected_type == "plant":
-                        result = plant_detector.analyze(processed_image)
-                        analysis_result = {
-                            'type': 'Plant Health',
-                            'result': result['condition'],
-                            'confidence': result['confidence'],
-                            'details': result['details']
-                        }
-                    elif detected_type == "soil":
-                        result = soil_detector.analyze(processed_image)
-                        analysis_result = {
-                            'type': 'Soil Health',
-                            'result': result['condition'],
-                            'confidence': result['confidence'],
-                            'details': result['details']
-                        }
-                    else:
-                        st.error("Could not determine image type. Please select manually.")
-                        st.stop()
-                    
-                    # Add timestamp
-                    analysis_result['timestamp'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    analysis_result['image_name'] = uploaded_file.name
-                    
-                    # Store in history
-                    st.session_state.analysis_history.append(analysis_result)
-                    
-                    # Backup analysis
-                    backup_manager.backup_analysis(analysis_result, uploaded_file)
+                # Display uploaded image (original bytes, no re-encode)
+                st.image(file_bytes, caption="Uploaded Image", use_container_width=True)
+                
+                # Analyse and record each upload once; reruns reuse the stored result
+                analysis_id = (uploaded_file.file_id, analysis_type)
+                if analysis_result is None or st.session_state.get('last_result_id') != analysis_id:
+                    with st.spinner("Processing image..."):
+                        analysis_result = analyze_bytes(file_bytes, analysis_type)
+                        if analysis_result is None:
+                            st.error("Could not determine image type. Please select manually.")
+                            st.stop()
+                        
+                        # Add timestamp
+                        analysis_result['timestamp'] = time.time()
+                        analysis_result['image_name'] = uploaded_file.name
+                        
+                        # Store in history
+                        record = {k: v for k, v in analysis_result.items() if k != 'recommendations'}
+                        history = st.session_state.analysis_history
+                        counts = st.session_state.counts
+                        if len(history) == history.maxlen:
+                            counts[history[0]['type']] -= 1
+                        history.append({k: record[k] for k in HISTORY_FIELDS})
+                        counts[record['type']] += 1
+                        
+                        # Persist and back up the analysis in the background
+                        backup_queue.put((record, file_bytes, uploaded_file.name))
+                        
+                        # Only mark the upload as recorded once every step succeeded
+                        st.session_state['last_result'] = analysis_result
+                        st.session_state['last_result_id'] = analysis_id
+                
+                if analysis_type == "Auto-detect":
+                    st.info(f"Auto-detected: {analysis_result['type'].replace(' Health', '').lower()}")
                 
             except Exception as e:
                 st.error(f"Error processing image: {str(e)}")
@@ -143,38 +274,33 @@ def main():
         st.header("📊 Analysis Results")
         
         if uploaded_file is not None:
-            try:
-                if 'analysis_result' in locals() and analysis_result is not None:
-                    # Display results
-                    if analysis_result['confidence'] >= confidence_threshold:
-                        if analysis_result['result'] in ['Healthy', 'Good']:
-                            st.success(f"✅ **{analysis_result['type']}**: {analysis_result['result']}")
-                        elif analysis_result['result'] in ['Moderate Issues', 'Fair']:
-                            st.warning(f"⚠️ **{analysis_result['type']}**: {analysis_result['result']}")
-                        else:
-                            st.error(f"❌ **{analysis_result['type']}**: {analysis_result['result']}")
-                        
-                        # Confidence score
-                        st.metric("Confidence Score", f"{analysis_result['confidence']:.2%}")
-                        
-                        # Detailed analysis
-                        st.subheader("Detailed Analysis")
-                        for key, value in analysis_result['details'].items():
-                            st.write(f"**{key.replace('_', ' ').title()}:** {value}")
-                        
-                        # Recommendations
-                        st.subheader("🎯 Recommendations")
-                        recommendations = recommendation_engine.get_recommendations(analysis_result)
-                        
-                        for i, rec in enumerate(recommendations, 1):
-                            st.write(f"{i}. {rec}")
-                        
+            if analysis_result is not None:
+                # Display results
+                if analysis_result['confidence'] >= confidence_threshold:
+                    if analysis_result['result'] in ['Healthy', 'Good']:
+                        st.success(f"✅ **{analysis_result['type']}**: {analysis_result['result']}")
+                    elif analysis_result['result'] in ['Moderate Issues', 'Fair']:
+                        st.warning(f"⚠️ **{analysis_result['type']}**: {analysis_result['result']}")
                     else:
-                        st.warning(f"Low confidence result ({analysis_result['confidence']:.2%}). Consider uploading a clearer image.")
+                        st.error(f"❌ **{analysis_result['type']}**: {analysis_result['result']}")
+                    
+                    # Confidence score
+                    st.metric("Confidence Score", f"{analysis_result['confidence']:.2%}")
+                    
+                    # Detailed analysis
+                    st.subheader("Detailed Analysis")
+                    for key, value in analysis_result['details'].items():
+                        st.write(f"**{key.replace('_', ' ').title()}:** {value}")
+                    
+                    # Recommendations
+                    st.subheader("🎯 Recommendations")
+                    for i, rec in enumerate(analysis_result['recommendations'], 1):
+                        st.write(f"{i}. {rec}")
+                    
                 else:
-                    st.info("Analysis in progress...")
-            except NameError:
-                st.info("Analysis not yet available...")
+                    st.warning(f"Low confidence result ({analysis_result['confidence']:.2%}). Consider uploading a clearer image.")
+            else:
+                st.info("Analysis in progress...")
         else:
             st.info("Upload an image to see analysis results here.")
     
@@ -187,12 +313,10 @@ def main():
         st.metric("Total Analyses", len(st.session_state.analysis_history))
     
     with col4:
-        plant_analyses = len([a for a in st.session_state.analysis_history if a['type'] == 'Plant Health'])
-        st.metric("Plant Analyses", plant_analyses)
+        st.metric("Plant Analyses", st.session_state.counts['Plant Health'])
     
     with col5:
-        soil_analyses = len([a for a in st.session_state.analysis_history if a['type'] == 'Soil Health'])
-        st.metric("Soil Analyses", soil_analyses)
+        st.metric("Soil Analyses", st.session_state.counts['Soil Health'])
     
     # Backup status
     backup_status = backup_manager.get_backup_status()
@@ -201,11 +325,16 @@ def main():
     # Export functionality
     if st.session_state.analysis_history:
         if st.button("📥 Export Analysis History"):
-            df = pd.DataFrame(st.session_state.analysis_history)
-            csv = df.to_csv(index=False)
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf, fieldnames=HISTORY_FIELDS)
+            writer.writeheader()
+            writer.writerows(
+                {**a, 'timestamp': format_timestamp(int(a['timestamp']))}
+                for a in st.session_state.analysis_history
+            )
             st.download_button(
                 label="Download CSV",
-                data=csv,
+                data=buf.getvalue(),
                 file_name=f"plant_soil_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
                 mime="text/csv"
             )